@@ -1,16 +1,28 @@
-import json
+import gzip
 import os
 import sys
+import numpy as np
+import orjson
 from sentence_transformers import SentenceTransformer
 
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+
+from utils.vector_math import quantize_int8
+
 DATA_DIR = os.path.join(BASE_DIR, "data")
 DOCS_PATH = os.path.join(DATA_DIR, "docs.json")
-VECTOR_STORE_PATH = os.path.join(DATA_DIR, "vector_store.json")
+CHUNKS_PATH = os.path.join(DATA_DIR, "chunks.json.gz")
+EMBEDDINGS_PATH = os.path.join(DATA_DIR, "embeddings.npy")
+EMBEDDINGS_I8_PATH = os.path.join(DATA_DIR, "embeddings_i8.npy")
 
 CHUNK_SIZE_WORDS = 300
 OVERLAP_WORDS = 50
 EMBEDDING_MODEL_NAME = "all-MiniLM-L6-v2"
+# Must match the server's EMBEDDING_ONNX_FILE so queries and documents share one model.
+EMBEDDING_ONNX_FILE = os.getenv("EMBEDDING_ONNX_FILE", "onnx/model.onnx")
+# encode() already sorts inputs by length, so each batch pads only to its own longest text.
+ENCODE_BATCH_SIZE = 64
 
 def chunk_text(text, chunk_size=CHUNK_SIZE_WORDS, overlap=OVERLAP_WORDS):
     words = text.split()
@@ -26,12 +38,16 @@ def chunk_text(text, chunk_size=CHUNK_SIZE_WORDS, overlap=OVERLAP_WORDS):
 
 def main():
     print(f"📦  Loading embedding model '{EMBEDDING_MODEL_NAME}' (downloads ~90MB on first run)...")
-    model = SentenceTransformer(EMBEDDING_MODEL_NAME)
+    model = SentenceTransformer(
+        EMBEDDING_MODEL_NAME,
+        backend="onnx",
+        model_kwargs={"file_name": EMBEDDING_ONNX_FILE},
+    )
     print("✅  Model ready.")
 
     print(f"\n📂  Loading documents...")
-    with open(DOCS_PATH, "r", encoding="utf-8") as f:
-        docs = json.load(f)
+    with open(DOCS_PATH, "rb") as f:
+        docs = orjson.loads(f.read())
     print(f"    Found {len(docs)} document(s).")
 
     print("\n✂️   Chunking documents...")
@@ -45,22 +61,31 @@ def main():
                 "title": doc["title"],
                 "content": chunk,
                 "chunk_index": idx,
-                "embedding": None
+                # Pre-rendered once so re-embedding doesn't rebuild the string.
+                "embed_text": f"{doc['title']}: {chunk}",
             })
     print(f"    Generated {len(all_chunks)} chunk(s).")
 
     print(f"\n🔢  Generating embeddings locally (no API key needed)...")
-    texts = [f"{c['title']}: {c['content']}" for c in all_chunks]
-    embeddings = model.encode(texts, normalize_embeddings=True, show_progress_bar=True)
-
-    for chunk, emb in zip(all_chunks, embeddings):
-        chunk["embedding"] = emb.tolist()
+    texts = [c["embed_text"] for c in all_chunks]
+    embeddings = model.encode(
+        texts,
+        batch_size=ENCODE_BATCH_SIZE,
+        normalize_embeddings=True,
+        convert_to_numpy=True,
+        show_progress_bar=True,
+    )
 
+    # Embeddings go to a row-aligned .npy matrix (memory-mapped by the server);
+    # chunk metadata goes to a slim, gzipped JSON sidecar.
     os.makedirs(DATA_DIR, exist_ok=True)
-    with open(VECTOR_STORE_PATH, "w", encoding="utf-8") as f:
-        json.dump(all_chunks, f, indent=2)
+    np.save(EMBEDDINGS_PATH, np.ascontiguousarray(embeddings, dtype=np.float32))
+    np.save(EMBEDDINGS_I8_PATH, quantize_int8(embeddings))
+    # Gzipped: chunk text compresses well and disk reads dominate cold start.
+    with gzip.open(CHUNKS_PATH, "wb") as f:
+        f.write(orjson.dumps(all_chunks))
 
-    print(f"\n✅  Vector store saved! {len(all_chunks)} chunks, {len(all_chunks[0]['embedding'])} dimensions.")
+    print(f"\n✅  Vector store saved! {len(all_chunks)} chunks, {embeddings.shape[1]} dimensions.")
     print("🚀  Now run: uvicorn server:app --reload --port 8000")
 
 if __name__ == "__main__":
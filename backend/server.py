@@ -1,33 +1,66 @@
 """
 server.py — Production-Grade RAG Chat Backend (Render Optimized)
 ------------------------------------------------------------------
-- Embeddings: local sentence-transformers (lazy loaded)
-- LLM:        OpenRouter only
+- Embeddings: local sentence-transformers, ONNX backend (lazy loaded)
+- LLM:        OpenRouter only, streamed to the client as Server-Sent Events
 - Safe for small cloud instances
 """
 
-import json
+import asyncio
+import gzip
 import os
+import re
 import sys
 import uuid
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, suppress
 from pathlib import Path
 
 from dotenv import load_dotenv
-from fastapi import FastAPI, HTTPException
-from fastapi.middleware.cors import CORSMiddleware
-from openai import OpenAI, APITimeoutError, RateLimitError, APIError
-from pydantic import BaseModel, field_validator
-from sentence_transformers import SentenceTransformer
 
 # ── Paths & env ──────────────────────────────────────────────────────────────
 BASE_DIR = Path(__file__).parent
 load_dotenv(BASE_DIR / ".env")
+
+# ── Threading (must be set before numpy / onnxruntime are imported) ──────────
+# Inference threads come from the ONNX Runtime SessionOptions built in
+# get_embedding_model(), sized by EMBED_THREADS. The OpenMP / BLAS pools only
+# serve NumPy's scoring matvec, which is tiny, so they stay single-threaded.
+EMBED_THREADS = int(os.getenv("EMBED_THREADS", "4"))
+os.environ.setdefault("OMP_NUM_THREADS", "1")
+os.environ.setdefault("MKL_NUM_THREADS", "1")
+os.environ.setdefault("OPENBLAS_NUM_THREADS", "1")
+os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")
+
+import numpy as np
+import orjson
+from fastapi import FastAPI, HTTPException
+from fastapi.concurrency import run_in_threadpool
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
+from openai import AsyncOpenAI, APITimeoutError, RateLimitError, APIError
+from pydantic import BaseModel, field_validator
+
 sys.path.insert(0, str(BASE_DIR))
 
-from utils.vector_math import top_k_similar
+from utils.vector_math import DEBUG_UNIT_NORM, HAS_SIMSIMD, assert_unit_norm, top_k_similar
 
 # ── App ──────────────────────────────────────────────────────────────────────
-app = FastAPI(title="University RAG Assistant", version="1.1.0")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    # The embedding batch worker is started lazily by get_embed_queue()
+    if embed_worker is not None and not embed_worker.done():
+        embed_worker.cancel()
+        with suppress(asyncio.CancelledError):
+            await embed_worker
+    # Fail whatever is still queued so no request waits on a worker that is gone
+    while embed_queue is not None and not embed_queue.empty():
+        _, future = embed_queue.get_nowait()
+        future.cancel()
+
+
+app = FastAPI(title="University RAG Assistant", version="1.1.0", lifespan=lifespan)
 
 FRONTEND_URL = os.getenv("FRONTEND_URL", "")
 
@@ -48,8 +81,13 @@ app.add_middleware(
 
 # ── Globals (lazy loaded) ────────────────────────────────────────────────────
 embedding_model = None
-vector_store = None
-sessions: dict[str, list] = {}
+chunk_metadata = None
+embeddings_matrix = None
+embeddings_i8 = None
+sessions: OrderedDict[str, deque] = OrderedDict()  # LRU order, oldest first
+embedding_cache: OrderedDict[str, np.ndarray] = OrderedDict()  # LRU order, oldest first
+embed_queue = None  # asyncio.Queue of (text, Future) pairs for embed_batch_worker
+embed_worker = None  # asyncio.Task draining embed_queue
 
 # ── Environment ──────────────────────────────────────────────────────────────
 OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY")
@@ -58,13 +96,28 @@ if not OPENROUTER_API_KEY:
 
 LLM_MODEL = os.getenv("OPENROUTER_MODEL", "mistralai/mistral-7b-instruct:free")
 EMBEDDING_MODEL_NAME = "all-MiniLM-L6-v2"
-VECTOR_STORE_PATH = BASE_DIR / "data" / "vector_store.json"
+# Same fp32 graph as ingest, so queries and documents share one embedding space.
+# "onnx/model_qint8_avx512_vnni.onnx" is faster on VNNI hosts, but its vectors drift
+# from the stored document vectors; only switch after re-running ingest with it.
+EMBEDDING_ONNX_FILE = os.getenv("EMBEDDING_ONNX_FILE", "onnx/model.onnx")
+CHUNKS_PATH = BASE_DIR / "data" / "chunks.json.gz"
+CHUNKS_PLAIN_PATH = BASE_DIR / "data" / "chunks.json"  # uncompressed stores from older ingests
+EMBEDDINGS_PATH = BASE_DIR / "data" / "embeddings.npy"
+EMBEDDINGS_I8_PATH = BASE_DIR / "data" / "embeddings_i8.npy"
+
+# Chunk fields carried into retrieval results
+RESULT_FIELDS = ("id", "title", "content")
 
 SIMILARITY_THRESHOLD = 0.30
 TOP_K = 3
 MAX_HISTORY_PAIRS = 5
+MAX_SESSIONS = int(os.getenv("MAX_SESSIONS", "10000"))
+EMBED_CACHE_SIZE = 2048
+# Micro-batching: queries arriving within this window share one encode() call
+EMBED_BATCH_MAX = 32
+EMBED_BATCH_WAIT_S = float(os.getenv("EMBED_BATCH_WAIT_MS", "5")) / 1000
 
-openrouter_client = OpenAI(
+openrouter_client = AsyncOpenAI(
     api_key=OPENROUTER_API_KEY,
     base_url="https://openrouter.ai/api/v1",
 )
@@ -89,23 +142,67 @@ def get_embedding_model():
     global embedding_model
     if embedding_model is None:
         print("📦 Loading embedding model...")
-        embedding_model = SentenceTransformer(EMBEDDING_MODEL_NAME)
+        # Heavy imports (torch, transformers, onnxruntime) are deferred to first use
+        # so the server boots fast and small instances don't OOM at startup.
+        import onnxruntime as ort
+        from sentence_transformers import SentenceTransformer
+
+        # The ONNX Runtime session runs inference, so its thread pools are the ones
+        # that matter; torch is imported by sentence-transformers but never executes.
+        session_options = ort.SessionOptions()
+        session_options.intra_op_num_threads = EMBED_THREADS
+        session_options.inter_op_num_threads = 1
+        embedding_model = SentenceTransformer(
+            EMBEDDING_MODEL_NAME,
+            backend="onnx",
+            model_kwargs={
+                "file_name": EMBEDDING_ONNX_FILE,
+                "session_options": session_options,
+            },
+        )
         print("✅ Embedding model ready.")
     return embedding_model
 
 
+def get_embed_queue() -> asyncio.Queue:
+    """Returns the embedding queue, (re)starting the batch worker if it is not running."""
+    global embed_queue, embed_worker
+    loop = asyncio.get_running_loop()
+    if embed_worker is None or embed_worker.done() or embed_worker.get_loop() is not loop:
+        embed_queue = asyncio.Queue()
+        embed_worker = loop.create_task(embed_batch_worker(embed_queue))
+    return embed_queue
+
+
 def get_vector_store():
-    global vector_store
-    if vector_store is None:
+    global chunk_metadata, embeddings_matrix, embeddings_i8
+    if chunk_metadata is None:
         print("📂 Loading vector store...")
-        if not VECTOR_STORE_PATH.exists():
+        chunks_path = CHUNKS_PATH if CHUNKS_PATH.exists() else CHUNKS_PLAIN_PATH
+        if not chunks_path.exists() or not EMBEDDINGS_PATH.exists():
             raise FileNotFoundError(
-                f"Vector store not found at {VECTOR_STORE_PATH}. Run ingest first."
+                f"Vector store not found at {CHUNKS_PATH.parent}. Run ingest first."
             )
-        with open(VECTOR_STORE_PATH, "r", encoding="utf-8") as f:
-            vector_store = json.load(f)
-        print(f"✅ Loaded {len(vector_store)} chunks.")
-    return vector_store
+        raw_bytes = chunks_path.read_bytes()
+        if chunks_path.suffix == ".gz":
+            raw_bytes = gzip.decompress(raw_bytes)
+        raw_chunks = orjson.loads(raw_bytes)
+        # Pre-shaped: keep only what retrieval results need, so each per-request
+        # {**meta, "score": ...} copy stays small (no embeddings, no embed_text).
+        metadata = [{field: c[field] for field in RESULT_FIELDS} for c in raw_chunks]
+        # Memory-mapped: pages are shared via the OS page cache, no parse step.
+        # ascontiguousarray is a no-op for .npy files written by ingest; it guards
+        # against Fortran-ordered input.
+        embeddings_matrix = np.ascontiguousarray(np.load(EMBEDDINGS_PATH, mmap_mode="r"))
+        if DEBUG_UNIT_NORM:
+            assert_unit_norm(embeddings_matrix, "stored embeddings")
+        # The int8 copy is 4x smaller but only pays off with SimSIMD kernels; it only
+        # shortlists candidates, final scores always come from the float32 matrix.
+        if HAS_SIMSIMD and EMBEDDINGS_I8_PATH.exists():
+            embeddings_i8 = np.ascontiguousarray(np.load(EMBEDDINGS_I8_PATH, mmap_mode="r"))
+        chunk_metadata = metadata
+        print(f"✅ Loaded {len(chunk_metadata)} chunks.")
+    return embeddings_matrix, embeddings_i8, chunk_metadata
 
 
 # ── Schemas ──────────────────────────────────────────────────────────────────
@@ -124,26 +221,134 @@ class ChatRequest(BaseModel):
         return v
 
 
-class ChatResponse(BaseModel):
-    reply: str
-    tokensUsed: int
+# /api/chat streams Server-Sent Events: one "meta", many "token", then "done" or "error"
+class ChatMeta(BaseModel):
     retrievedChunks: int
     scores: list[float]
     sessionId: str
 
 
+class ChatToken(BaseModel):
+    text: str
+
+
+class ChatDone(BaseModel):
+    reply: str
+    tokensUsed: int
+
+
+class ChatError(BaseModel):
+    detail: str
+
+
 # ── Core Logic ───────────────────────────────────────────────────────────────
-def embed_query(text: str) -> list[float]:
+_WHITESPACE_RE = re.compile(r"\s+")
+
+
+def normalize_query(text: str) -> str:
+    """
+    Cache key for a query: lowercased, whitespace collapsed, trailing ?!. dropped.
+    Only used for lookups — the model always embeds the original text.
+    """
+    key = _WHITESPACE_RE.sub(" ", text.lower()).strip()
+    return key.rstrip("?!.").rstrip()
+
+
+def encode_batch(texts: list[str]) -> np.ndarray:
+    model = get_embedding_model()
+    return model.encode(
+        texts,
+        batch_size=len(texts),
+        normalize_embeddings=True,
+        convert_to_numpy=True,
+    )
+
+
+async def embed_batch_worker(queue: asyncio.Queue):
+    """Drains up to EMBED_BATCH_MAX queued texts (or waits EMBED_BATCH_WAIT_S) per encode."""
+    loop = asyncio.get_running_loop()
+    batch = []
     try:
-        model = get_embedding_model()
-        return model.encode(text, normalize_embeddings=True).tolist()
+        while True:
+            batch = [await queue.get()]
+            deadline = loop.time() + EMBED_BATCH_WAIT_S
+            while len(batch) < EMBED_BATCH_MAX:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            try:
+                vectors = await run_in_threadpool(encode_batch, [text for text, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            for (_, future), vector in zip(batch, vectors):
+                if not future.done():
+                    future.set_result(vector)
+    finally:
+        # Cancelled mid-batch (shutdown): release callers already dequeued.
+        # cancel() is a no-op on futures that already have a result.
+        for _, future in batch:
+            future.cancel()
+
+
+async def embed_query(text: str) -> np.ndarray:
+    key = normalize_query(text) or text
+    vector = embedding_cache.get(key)
+    if vector is not None:
+        embedding_cache.move_to_end(key)
+        return vector
+
+    try:
+        future = asyncio.get_running_loop().create_future()
+        await get_embed_queue().put((text, future))
+        vector = await future
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Embedding error: {e}")
 
+    # Copy the row out of the (B, 384) batch array so caching it doesn't keep the
+    # whole batch alive
+    vector = vector.copy()
+    vector.flags.writeable = False  # shared by every caller that hits the cache
+    embedding_cache[key] = vector
+    if len(embedding_cache) > EMBED_CACHE_SIZE:
+        embedding_cache.popitem(last=False)
+    return vector
+
+
+def retrieve_chunks(query_vector: np.ndarray) -> list[dict]:
+    matrix, matrix_i8, metadata = get_vector_store()
+    return top_k_similar(
+        query_vector, matrix, metadata, k=TOP_K, threshold=SIMILARITY_THRESHOLD,
+        matrix_i8=matrix_i8,
+    )
+
+
+def new_history() -> deque:
+    # Bounded: appending past the cap drops the oldest message in O(1)
+    return deque(maxlen=MAX_HISTORY_PAIRS * 2)
+
 
-def retrieve_chunks(query_vector: list[float]) -> list[dict]:
-    store = get_vector_store()
-    return top_k_similar(query_vector, store, k=TOP_K, threshold=SIMILARITY_THRESHOLD)
+def get_history(session_id: str) -> deque:
+    """
+    Returns the session's history, creating it and evicting the LRU session if full.
+    Not thread-safe: call only from async endpoints so it runs on the event loop.
+    """
+    history = sessions.get(session_id)
+    if history is None:
+        history = sessions[session_id] = new_history()
+        if len(sessions) > MAX_SESSIONS:
+            sessions.popitem(last=False)
+    else:
+        sessions.move_to_end(session_id)
+    return history
 
 
 def build_messages(retrieved, history, question):
@@ -153,7 +358,7 @@ def build_messages(retrieved, history, question):
     ) if retrieved else "No relevant documents found."
 
     messages = [{"role": "system", "content": SYSTEM_PROMPT}]
-    messages.extend(history[-(MAX_HISTORY_PAIRS * 2):])
+    messages.extend(history)
     messages.append({
         "role": "user",
         "content": f"RETRIEVED CONTEXT:\n{context}\n\nUSER QUESTION: {question}\n\nANSWER:"
@@ -161,18 +366,17 @@ def build_messages(retrieved, history, question):
     return messages
 
 
-def call_openrouter(messages):
+async def open_openrouter_stream(messages):
+    # Errors on the initial request surface as normal HTTP errors, before any bytes are sent
     try:
-        response = openrouter_client.chat.completions.create(
+        return await openrouter_client.chat.completions.create(
             model=LLM_MODEL,
             messages=messages,
             max_tokens=1024,
             temperature=0.2,
+            stream=True,
+            stream_options={"include_usage": True},
         )
-        reply = (response.choices[0].message.content or "").strip()
-        tokens = response.usage.total_tokens if response.usage else 0
-        return reply or FALLBACK_TEXT, tokens
-
     except RateLimitError:
         raise HTTPException(status_code=429, detail="Rate limit reached.")
     except APITimeoutError:
@@ -181,6 +385,10 @@ def call_openrouter(messages):
         raise HTTPException(status_code=502, detail=str(e))
 
 
+def sse_event(event: str, payload: BaseModel) -> str:
+    return f"event: {event}\ndata: {payload.model_dump_json()}\n\n"
+
+
 # ── Routes ───────────────────────────────────────────────────────────────────
 @app.get("/")
 def root():
@@ -193,42 +401,67 @@ def health():
         "status": "ok",
         "llmModel": LLM_MODEL,
         "embeddingModel": EMBEDDING_MODEL_NAME,
+        "embeddingBackend": f"onnx ({EMBEDDING_ONNX_FILE})",
     }
 
 
-@app.post("/api/chat", response_model=ChatResponse)
+@app.post("/api/chat")
 async def chat(req: ChatRequest):
-    if req.sessionId not in sessions:
-        sessions[req.sessionId] = []
-
-    history = sessions[req.sessionId]
+    history = get_history(req.sessionId)
 
-    query_vector = embed_query(req.message)
-    retrieved = retrieve_chunks(query_vector)
+    # Embedding is batched on a worker thread; scoring also runs off the event loop
+    query_vector = await embed_query(req.message)
+    retrieved = await run_in_threadpool(retrieve_chunks, query_vector)
     messages = build_messages(retrieved, history, req.message)
-    reply, tokens = call_openrouter(messages)
-
-    history.append({"role": "user", "content": req.message})
-    history.append({"role": "assistant", "content": reply})
-    sessions[req.sessionId] = history[-(MAX_HISTORY_PAIRS * 2):]
-
-    return ChatResponse(
-        reply=reply,
-        tokensUsed=tokens,
-        retrievedChunks=len(retrieved),
-        scores=[float(c["score"]) for c in retrieved],
-        sessionId=req.sessionId,
+    stream = await open_openrouter_stream(messages)
+
+    async def events():
+        yield sse_event("meta", ChatMeta(
+            retrievedChunks=len(retrieved),
+            scores=[c["score"] for c in retrieved],
+            sessionId=req.sessionId,
+        ))
+
+        parts = []
+        tokens = 0
+        try:
+            # Closes the upstream response even if the client disconnects mid-reply
+            async with stream:
+                async for chunk in stream:
+                    if chunk.usage:
+                        tokens = chunk.usage.total_tokens
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        delta = chunk.choices[0].delta.content
+                        parts.append(delta)
+                        yield sse_event("token", ChatToken(text=delta))
+        except APIError as e:
+            yield sse_event("error", ChatError(detail=str(e)))
+            return
+        except Exception as e:
+            yield sse_event("error", ChatError(detail=f"Streaming error: {e}"))
+            return
+
+        # History is only recorded once the full reply has been streamed
+        reply = "".join(parts).strip() or FALLBACK_TEXT
+        history.append({"role": "user", "content": req.message})
+        history.append({"role": "assistant", "content": reply})
+        yield sse_event("done", ChatDone(reply=reply, tokensUsed=tokens))
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
     )
 
 
 @app.post("/api/session/new")
-def new_session():
+async def new_session():
     sid = str(uuid.uuid4())
-    sessions[sid] = []
+    get_history(sid)
     return {"sessionId": sid}
 
 
 @app.delete("/api/session/{session_id}")
-def clear_session(session_id: str):
+async def clear_session(session_id: str):
     sessions.pop(session_id, None)
     return {"cleared": True, "sessionId": session_id}
\ No newline at end of file
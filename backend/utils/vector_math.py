@@ -1,44 +1,111 @@
+import os
+
 import numpy as np
 
+try:
+    import simsimd
+except ImportError:  # optional: falls back to float32 matmul
+    simsimd = None
+
+HAS_SIMSIMD = simsimd is not None
+
+# Unit-norm components lie in [-1, 1], so scaling by 127 fits int8 exactly.
+INT8_SCALE = 127
+
+# int8 scores drift ~0.005 from float32, so the int8 pass shortlists k * this many
+# candidates and the final ranking + threshold use exact float32 scores.
+RESCORE_OVERSAMPLE = 4
+
+# VECTOR_MATH_DEBUG=1 asserts the unit-norm precondition on the stored matrix (once,
+# at load) and on every query vector
+DEBUG_UNIT_NORM = os.getenv("VECTOR_MATH_DEBUG") == "1"
 
-def cosine_similarity(vec_a: list, vec_b: list) -> float:
+
+def quantize_int8(vectors) -> np.ndarray:
     """
-    Computes the cosine similarity between two vectors.
-    Returns a float between -1 and 1, where 1 = identical direction.
+    Quantizes unit-norm float vectors to int8 by scaling to [-127, 127] and rounding.
     """
-    a = np.array(vec_a, dtype=np.float64)
-    b = np.array(vec_b, dtype=np.float64)
+    scaled = np.asarray(vectors, dtype=np.float32) * INT8_SCALE
+    return np.round(scaled).astype(np.int8)
 
-    norm_a = np.linalg.norm(a)
-    norm_b = np.linalg.norm(b)
 
-    # Guard against division by zero
-    if norm_a == 0 or norm_b == 0:
-        return 0.0
+def assert_unit_norm(vectors, name: str = "vectors", tol: float = 1e-3) -> None:
+    """
+    Asserts every row of `vectors` (or a single vector) has L2 norm 1 within tol.
+    Scoring relies on this to reduce cosine similarity to a dot product.
+    """
+    norms = np.linalg.norm(np.atleast_2d(np.asarray(vectors, dtype=np.float32)), axis=1)
+    assert np.all(np.abs(norms - 1.0) < tol), f"{name}: not unit-norm"
 
-    return float(np.dot(a, b) / (norm_a * norm_b))
 
+def top_k_indices(scores: np.ndarray, k: int, threshold: float) -> np.ndarray:
+    """
+    Returns indices of the k highest scores at or above threshold, sorted descending.
 
-def top_k_similar(query_vector: list, documents: list, k: int = 3, threshold: float = 0.4) -> list:
+    Uses np.argpartition for an O(N) selection, then sorts only the k survivors
+    instead of the full score array.
     """
-    Given a query embedding and a list of document dicts (each with an 'embedding' key),
-    returns the top-k documents sorted by cosine similarity, filtered by threshold.
+    if k <= 0:
+        return np.empty(0, dtype=np.intp)
+    if k < len(scores):
+        idx = np.argpartition(-scores, k)[:k]
+    else:
+        idx = np.arange(len(scores))
+    idx = idx[np.argsort(-scores[idx])]
+    return idx[scores[idx] >= threshold]
+
+
+def _with_scores(metadata: list, idx: np.ndarray, scores: np.ndarray) -> list:
+    # One bulk .tolist() per array instead of a float()/round() call per match
+    return [
+        {**metadata[i], "score": score}
+        for i, score in zip(idx.tolist(), scores.tolist())
+    ]
+
+
+def top_k_similar(
+    query_vector,
+    matrix: np.ndarray,
+    metadata: list,
+    k: int = 3,
+    threshold: float = 0.4,
+    matrix_i8: np.ndarray = None,
+) -> list:
+    """
+    Given a query embedding and the document store in struct-of-arrays form, returns
+    the top-k documents sorted by cosine similarity, filtered by threshold.
+
+    All embeddings are expected to be unit-norm (encoded with normalize_embeddings=True),
+    so cosine similarity reduces to a single matrix-vector product.
 
     Args:
         query_vector: The embedding of the user query.
-        documents: List of dicts, each containing at least {"embedding": [...], ...}.
+        matrix: Contiguous (N, dim) float32 matrix of document embeddings.
+        metadata: List of N document dicts (without embeddings), row-aligned with `matrix`.
         k: Number of top results to return.
         threshold: Minimum similarity score to consider a document relevant.
+        matrix_i8: Optional int8 copy of `matrix` (see quantize_int8). With SimSIMD it is
+            used to shortlist candidates, which are then re-scored against `matrix`.
 
     Returns:
-        List of document dicts with an additional 'score' key, sorted descending.
+        List of metadata dicts with an additional 'score' key, sorted descending.
     """
-    scored = []
-    for doc in documents:
-        score = cosine_similarity(query_vector, doc["embedding"])
-        if score >= threshold:
-            scored.append({**doc, "score": round(score, 6)})
+    if len(metadata) == 0:
+        return []
+
+    q = np.asarray(query_vector, dtype=np.float32)
+    if DEBUG_UNIT_NORM:
+        assert_unit_norm(q, "query vector")
+
+    if matrix_i8 is not None and HAS_SIMSIMD:
+        # SimSIMD returns cosine *distance*; int8 vectors are renormalized internally
+        distances = simsimd.cdist(quantize_int8(q)[None, :], matrix_i8, metric="cosine")
+        approx = 1.0 - np.asarray(distances)[0]
+        candidates = top_k_indices(approx, k * RESCORE_OVERSAMPLE, -np.inf)
+        exact = matrix[candidates] @ q
+        order = top_k_indices(exact, k, threshold)
+        return _with_scores(metadata, candidates[order], exact[order])
 
-    # Sort by score descending and return top k
-    scored.sort(key=lambda x: x["score"], reverse=True)
-    return scored[:k]
+    scores = matrix @ q
+    idx = top_k_indices(scores, k, threshold)
+    return _with_scores(metadata, idx, scores[idx])
@@ -2,7 +2,7 @@ import { useState } from "react";
 import { v4 as uuidv4 } from "uuid";
 import ChatWindow from "./components/ChatWindow";
 import Sidebar from "./components/Sidebar";
-import { sendMessage, clearSession } from "./api";
+import { streamMessage, clearSession } from "./api";
 
 const SESSION_KEY = "rag_session_id";
 
@@ -27,6 +27,7 @@ export default function App() {
   const [sessionId, setSessionId] = useState(getOrCreateSession);
   const [messages,  setMessages]  = useState([WELCOME]);
   const [isLoading, setIsLoading] = useState(false);
+  const [isStreaming, setIsStreaming] = useState(false);
   const [lastMeta,  setLastMeta]  = useState(null);
 
   const handleSend = async (text) => {
@@ -38,13 +39,21 @@ export default function App() {
     ]);
     setIsLoading(true);
 
+    const replyId = uuidv4();
+    const setReply = (update) =>
+      setMessages((prev) =>
+        prev.some((m) => m.id === replyId)
+          ? prev.map((m) => (m.id === replyId ? { ...m, content: update(m.content) } : m))
+          : [...prev, { id: replyId, role: "assistant", content: update(""), timestamp: new Date().toISOString() }]
+      );
+
     try {
-      const data = await sendMessage(sessionId, text);
+      const data = await streamMessage(sessionId, text, (delta) => {
+        setIsStreaming(true);
+        setReply((content) => content + delta);
+      });
 
-      setMessages((prev) => [
-        ...prev,
-        { id: uuidv4(), role: "assistant", content: data.reply, timestamp: new Date().toISOString() },
-      ]);
+      setReply(() => data.reply);
       setLastMeta({
         tokensUsed:      data.tokensUsed,
         retrievedChunks: data.retrievedChunks,
@@ -61,6 +70,7 @@ export default function App() {
       ]);
     } finally {
       setIsLoading(false);
+      setIsStreaming(false);
     }
   };
 
@@ -97,7 +107,12 @@ export default function App() {
           </div>
         </header>
 
-        <ChatWindow messages={messages} isLoading={isLoading} onSend={handleSend} />
+        <ChatWindow
+          messages={messages}
+          isLoading={isLoading}
+          isStreaming={isStreaming}
+          onSend={handleSend}
+        />
       </div>
     </div>
   );
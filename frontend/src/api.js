@@ -3,14 +3,48 @@
 
 const BASE = import.meta.env.VITE_API_URL || "";
 
-export async function sendMessage(sessionId, message) {
+// /api/chat streams Server-Sent Events: "meta" (retrieval info), "token" (reply
+// deltas, passed to onToken as they arrive), then "done" (final reply + usage) or "error".
+export async function streamMessage(sessionId, message, onToken) {
   const res = await fetch(`${BASE}/api/chat`, {
     method: "POST",
     headers: { "Content-Type": "application/json" },
     body: JSON.stringify({ sessionId, message }),
   });
   if (!res.ok) throw new Error(`Chat error: ${res.status}`);
-  return res.json();
+
+  const reader = res.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = "";
+  let meta = {};
+
+  while (true) {
+    const { value, done } = await reader.read();
+    if (done) break;
+    buffer += decoder.decode(value, { stream: true });
+
+    let boundary;
+    while ((boundary = buffer.indexOf("\n\n")) !== -1) {
+      const { event, data } = parseEvent(buffer.slice(0, boundary));
+      buffer = buffer.slice(boundary + 2);
+
+      if (event === "meta") meta = data;
+      else if (event === "token") onToken(data.text);
+      else if (event === "error") throw new Error(data.detail);
+      else if (event === "done") return { ...meta, ...data };
+    }
+  }
+  throw new Error("Chat stream ended unexpectedly.");
+}
+
+function parseEvent(raw) {
+  let event = "message";
+  let data = "";
+  for (const line of raw.split("\n")) {
+    if (line.startsWith("event: ")) event = line.slice(7);
+    else if (line.startsWith("data: ")) data += line.slice(6);
+  }
+  return { event, data: data ? JSON.parse(data) : {} };
 }
 
 export async function newSession() {
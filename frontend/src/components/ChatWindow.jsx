@@ -3,7 +3,7 @@ import Message from "./Message";
 import InputBar from "./InputBar";
 import TypingIndicator from "./TypingIndicator";
 
-export default function ChatWindow({ messages, isLoading, onSend }) {
+export default function ChatWindow({ messages, isLoading, isStreaming, onSend }) {
   const bottomRef = useRef(null);
 
   // Auto-scroll to bottom when messages or loading state change
@@ -19,8 +19,8 @@ export default function ChatWindow({ messages, isLoading, onSend }) {
           <Message key={msg.id} message={msg} />
         ))}
 
-        {/* Loading / typing indicator */}
-        {isLoading && <TypingIndicator />}
+        {/* Loading / typing indicator — hidden once reply tokens start arriving */}
+        {isLoading && !isStreaming && <TypingIndicator />}
 
         {/* Invisible anchor to scroll to */}
         <div ref={bottomRef} />